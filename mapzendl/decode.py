@@ -0,0 +1,159 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+
+import imagecodecs
+import numpy as np
+from tqdm.asyncio import tqdm
+
+
+MAX_PENDING_TILES = 64
+PERCENTILE_SAMPLE_SIZE = 1_000_000
+# Pixels normalised per block, which bounds the float32 working copy to
+# 16MB however wide the output is
+NORMALIZE_BLOCK_PIXELS = 1 << 22
+
+# Lookup tables for the separable terrarium encoding,
+# (red * 256 + green + blue / 256) - 32768, with the offset folded into red
+TERRARIUM_LUT_R = np.arange(256, dtype=np.float32) * 256 - 32768
+TERRARIUM_LUT_G = np.arange(256, dtype=np.float32)
+TERRARIUM_LUT_B = np.arange(256, dtype=np.float32) / 256
+
+# A decode worker's mapping of the mosaic, set up by open_mosaic
+worker_mosaic = None
+
+
+def decode_terrarium(image_array, out):
+	# Decodes a terrarium RGB tile straight into the float32 array out, using
+	# table lookups instead of per-pixel arithmetic. Negative heights (below
+	# sea level) are clamped to 0.
+	np.take(TERRARIUM_LUT_R, image_array[:, :, 0], out=out)
+	out += TERRARIUM_LUT_G[image_array[:, :, 1]]
+	out += TERRARIUM_LUT_B[image_array[:, :, 2]]
+	np.maximum(out, 0, out=out)
+
+def open_mosaic(mosaic_path):
+	# Decode worker initializer. Maps the mosaic once per worker, rather than
+	# once per tile, which would fault its pages in again every time. The
+	# mapping goes away when the worker exits at the end of the run.
+	global worker_mosaic
+	worker_mosaic = np.load(mosaic_path, mmap_mode="r+")
+
+def decode_tile_into_mosaic(image_data, x, y):
+	# Decodes a terrarium PNG and writes its heights, in whole metres, straight
+	# into the memory mapped mosaic at pixel (x, y). Runs in the decode worker
+	# processes; all processes map the same file, so no pixel data is sent
+	# back to the main process.
+	# imagecodecs decodes straight to a contiguous uint8 array, skipping
+	# PIL's mode handling and buffer copy. Alpha, if any, is ignored.
+	image_array = imagecodecs.png_decode(image_data)[..., :3]
+	heightmap = np.empty(image_array.shape[:2], dtype=np.float32)
+	decode_terrarium(image_array, heightmap)
+	worker_mosaic[y:y+256, x:x+256] = heightmap
+
+def normalize_height_data(data, out):
+	# Normalises the heights in data to the full range of out's unsigned
+	# integer dtype. Works through blocks of rows so that neither array has to
+	# fit in memory, which lets both be memory mapped.
+	# The window and spread only need to be approximate, so on large outputs
+	# they're estimated from a fixed random sample rather than every pixel
+	if data.size > PERCENTILE_SAMPLE_SIZE:
+		rng = np.random.default_rng(0)
+		indices = np.sort(rng.choice(data.size, size=PERCENTILE_SAMPLE_SIZE, replace=False))
+		sample = data[np.unravel_index(indices, data.shape)]
+	else:
+		sample = np.ravel(data)
+	sample = sample.astype(np.float32)
+	min_window, max_window = np.quantile(sample, [0.00005, 0.99995])
+	std_dev = np.std(sample)
+
+	actual_min = np.min(data)
+	actual_max = np.max(data)
+
+	# Adjust min and max if within 1 standard deviation of windowed values
+	min_val = actual_min if abs(actual_min - min_window) <= std_dev else min_window
+	max_val = actual_max if abs(actual_max - max_window) <= std_dev else max_window
+
+	out_max = np.iinfo(out.dtype).max
+	scale = out_max / (max_val - min_val)
+	# Overshoots due to outliers can't happen if the window is the full range
+	# of the data, in which case the clip can be skipped
+	clip = min_val != actual_min or max_val != actual_max
+
+	block_rows = max(1, NORMALIZE_BLOCK_PIXELS // data.shape[1])
+	for row in range(0, data.shape[0], block_rows):
+		block = data[row:row + block_rows].astype(np.float32)
+		block -= min_val
+		block *= scale
+		if clip:
+			np.clip(block, 0, out_max, out=block)
+		out[row:row + block_rows] = block
+
+	return out
+
+
+# Decodes every tile from the queue into the .npy mosaic at mosaic_path. The
+# mosaic is left on disk rather than returned, so that no mapping of it
+# outlives this call; read it back with np.load(mosaic_path, mmap_mode="r").
+async def process_tiles(queue, concat_dimensions, offsets, mosaic_path):
+	num_tiles = concat_dimensions[0] * concat_dimensions[1]
+	# Terrarium heights fit in int16, which keeps the mosaic at a quarter of
+	# the size of a float64 one. It's only widened for normalisation. It's
+	# stored row-major as (height, width), the same layout as the tiles and
+	# the final image, so neither the pastes nor the save need a transpose.
+	# The mosaic is backed by a file at mosaic_path, so large areas don't
+	# have to fit in RAM, and the decode workers write into it directly. This
+	# process only creates the file, and drops its own mapping straight away.
+	output_image = np.lib.format.open_memmap(
+		mosaic_path,
+		mode="w+",
+		dtype=np.int16,
+		shape=(concat_dimensions[1] * 256, concat_dimensions[0] * 256),
+	)
+	del output_image
+	loop = asyncio.get_running_loop()
+
+	# Limits the tiles being decoded at once, so that when decoding falls
+	# behind the queue fills up and the downloads wait, rather than the raw
+	# PNGs piling up in memory
+	decode_slots = asyncio.Semaphore(MAX_PENDING_TILES)
+
+	# Plain ints, so looking up a tile's offset is a single list index
+	offsets = offsets.tolist()
+
+	t = tqdm(total=num_tiles, unit="tiles", desc="process")
+
+	async def decode_tile(executor, tile_index, image_data):
+		x, y = offsets[tile_index]
+		try:
+			await loop.run_in_executor(
+				executor, decode_tile_into_mosaic, image_data, x, y
+			)
+		finally:
+			decode_slots.release()
+		t.update()
+
+	# PNG decoding is CPU bound, so it runs in worker processes to keep the
+	# event loop free for downloads. The pool only lives for this run, so
+	# shutting it down releases the workers' mappings of the mosaic and the
+	# scratch file can be deleted (which Windows refuses while mapped).
+	# Workers are spawned rather than forked: by the first submit the download
+	# side already has cache threads running, and forking a threaded process
+	# can deadlock. Spawned workers only need to import this module, and
+	# start without any of the parent's state.
+	with concurrent.futures.ProcessPoolExecutor(
+		max_workers=os.cpu_count(),
+		mp_context=multiprocessing.get_context("spawn"),
+		initializer=open_mosaic,
+		initargs=(mosaic_path,),
+	) as executor:
+		async with asyncio.TaskGroup() as tg:
+			while True:
+				await decode_slots.acquire()
+				input = await queue.get()
+				if input is None:
+					# No more images to process
+					break
+
+				tg.create_task(decode_tile(executor, *input))
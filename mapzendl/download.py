@@ -0,0 +1,121 @@
+import asyncio
+import os
+import random
+
+import aiohttp
+import diskcache
+from platformdirs import user_cache_dir
+from tqdm.asyncio import tqdm
+
+
+URL_BASE = "https://s3.amazonaws.com/elevation-tiles-prod/terrarium/"
+CACHE_DIR = user_cache_dir("mapzenDL", "ffernn")
+# Tiles are cached in a single SQLite-backed store keyed by (z, x, y) rather
+# than as millions of tiny files. The raised min file size keeps tiles inside
+# the database instead of spilling them out to separate files. It lives in
+# its own subdirectory; the z/x/y.png files older versions left directly in
+# CACHE_DIR aren't read by it and can be deleted.
+CACHE = diskcache.Cache(
+	os.path.join(CACHE_DIR, "tiles"), size_limit=50 << 30, disk_min_file_size=1 << 20
+)
+# Everything comes from one S3 host, so this is also the connection limit.
+# Admitting more tasks than connections would only have them queue for a
+# pooled connection while their request timeout runs.
+MAX_CONCURRENT_DOWNLOADS = 16
+MAX_RETRIES = 6
+MAX_BACKOFF = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def tile_coords_to_filepath(z, x, y):
+	return f"{z}/{x}/{y}.png"
+
+
+def tile_requests(tiles):
+	# Builds the cache key and URL of every tile in one pass up front, so the
+	# download coroutines don't have to
+	return [
+		((z, x, y), URL_BASE + tile_coords_to_filepath(z, x, y))
+		for z, x, y in tiles.tolist()
+	]
+
+
+async def collect_tiles(queue, tiles):
+	# A single pooled connector keeps connections alive across tiles, so the
+	# TLS and DNS cost is paid once per connection instead of once per tile.
+	connector = aiohttp.TCPConnector(
+		limit=MAX_CONCURRENT_DOWNLOADS,
+		limit_per_host=MAX_CONCURRENT_DOWNLOADS,
+		ttl_dns_cache=300,
+		keepalive_timeout=30,
+		enable_cleanup_closed=True,
+	)
+	timeout = aiohttp.ClientTimeout(total=30)
+	semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+
+	async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+		with tqdm(total=len(tiles), unit="tiles", desc="download") as progress:
+			async with asyncio.TaskGroup() as tg:
+				for tile_index, (key, url) in enumerate(tile_requests(tiles)):
+					task = tg.create_task(
+						download_tile(session, semaphore, key, url, tile_index, queue)
+					)
+					task.add_done_callback(lambda _: progress.update())
+
+	# Signal done
+	await queue.put(None)
+
+
+def backoff_delay(attempt, retry_after=None):
+	# Honours the server's Retry-After (in seconds) when given, otherwise
+	# falls back to exponential backoff with jitter.
+	if retry_after is not None:
+		try:
+			return min(float(retry_after), MAX_BACKOFF)
+		except ValueError:
+			pass
+	return min(2**attempt + random.random(), MAX_BACKOFF)
+
+
+# Downloads a single tile, retrying on connection errors, throttling and
+# server errors. Raises once the retries are exhausted so the failure
+# surfaces instead of leaving a hole in the output.
+async def fetch_tile(session, url):
+	for attempt in range(MAX_RETRIES):
+		final_attempt = attempt == MAX_RETRIES - 1
+		try:
+			async with session.get(url) as response:
+				if response.status == 200:
+					return await response.read()
+				if response.status not in RETRY_STATUSES or final_attempt:
+					# raise_for_status only covers >= 400, but any other status
+					# (204, an unfollowed redirect, ...) means there's no tile
+					raise aiohttp.ClientResponseError(
+						response.request_info,
+						response.history,
+						status=response.status,
+						message=response.reason or "",
+						headers=response.headers,
+					)
+				retry_after = response.headers.get("Retry-After")
+		except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+			if final_attempt:
+				raise
+			retry_after = None
+
+		await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+
+# Checks the cache for the given tile. If found, returns that,
+# if not, downloads and caches the tile. Cache lookups run in the default
+# thread pool so they don't block the event loop.
+async def download_tile(session, semaphore, key, url, tile_index, queue):
+	async with semaphore:
+		loop = asyncio.get_running_loop()
+
+		image_data = await loop.run_in_executor(None, CACHE.get, key)
+		if image_data is None:
+			image_data = await fetch_tile(session, url)
+			await loop.run_in_executor(None, CACHE.set, key, image_data)
+
+		await queue.put((tile_index, image_data))
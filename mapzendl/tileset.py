@@ -0,0 +1,85 @@
+import math
+
+import numpy as np
+
+
+EARTH_CIRCUMFERENCE = 20037508.34278924
+
+
+def epsg_3857_to_pixel(coords, zoom):
+	# Returns the pixel within the Slippymap tile that each of the given
+	# (N, 2) EPSG:3857 coordinates falls onto.
+	coords = np.asarray(coords, dtype=np.float64)
+	output = np.empty_like(coords)
+	output[:, 0] = (EARTH_CIRCUMFERENCE + coords[:, 0]) / (2 * EARTH_CIRCUMFERENCE)
+	output[:, 1] = (EARTH_CIRCUMFERENCE - coords[:, 1]) / (2 * EARTH_CIRCUMFERENCE)
+
+	# Work in whole-world pixels (256 per tile), so the offset within the
+	# tile is just the low 8 bits
+	output *= float(1 << (zoom + 8))
+	return np.floor(output).astype(np.int64) & 0xFF
+
+def epsg_3857_to_tile(coords, zoom):
+	# Returns the Slippymap tile that each of the given (N, 2) EPSG:3857
+	# coordinates falls into
+	coords = np.asarray(coords, dtype=np.float64)
+	output = np.empty_like(coords)
+	output[:, 0] = (EARTH_CIRCUMFERENCE + coords[:, 0]) / (2 * EARTH_CIRCUMFERENCE)
+	output[:, 1] = (EARTH_CIRCUMFERENCE - coords[:, 1]) / (2 * EARTH_CIRCUMFERENCE)
+
+	output *= float(1 << zoom)
+	return np.floor(output).astype(np.int32)
+
+def epsg_3857_to_pixel_scalar(x, y, zoom):
+	# Single coordinate version of epsg_3857_to_pixel, which skips the NumPy
+	# overhead when only one point is needed
+	n = 1 << (zoom + 8)
+	pixel_x = math.floor((EARTH_CIRCUMFERENCE + x) / (2 * EARTH_CIRCUMFERENCE) * n)
+	pixel_y = math.floor((EARTH_CIRCUMFERENCE - y) / (2 * EARTH_CIRCUMFERENCE) * n)
+	return pixel_x & 0xFF, pixel_y & 0xFF
+
+def epsg_3857_to_tile_scalar(x, y, zoom):
+	# Single coordinate version of epsg_3857_to_tile
+	n = 1 << zoom
+	tile_x = math.floor((EARTH_CIRCUMFERENCE + x) / (2 * EARTH_CIRCUMFERENCE) * n)
+	tile_y = math.floor((EARTH_CIRCUMFERENCE - y) / (2 * EARTH_CIRCUMFERENCE) * n)
+	return tile_x, tile_y
+
+
+class TileSet:
+	def __init__(self, bounding_box, zoom):
+		self.left, self.bottom = epsg_3857_to_tile_scalar(*bounding_box[:2], zoom)
+		self.right, self.top = epsg_3857_to_tile_scalar(*bounding_box[2:], zoom)
+		self.left_pixel, self.bottom_pixel = epsg_3857_to_pixel_scalar(*bounding_box[:2], zoom)
+		self.right_pixel, self.top_pixel = epsg_3857_to_pixel_scalar(*bounding_box[2:], zoom)
+
+		self.zoom = zoom
+
+		self.width = self.right - self.left + 1
+		self.height = self.bottom - self.top + 1
+
+		self.right_pixel += (self.width - 1) * 256
+		self.bottom_pixel += (self.height - 1) * 256
+
+	def count(self):
+		# Returns the total number of tiles in the tileset
+		return self.width * self.height
+
+	def tiles_array(self):
+		# Returns an (N, 3) array of the [z, x, y] coordinates of every tile in
+		# the tileset, ordered row by row from the top left
+		xs, ys = np.meshgrid(
+			np.arange(self.left, self.right + 1, dtype=np.int32),
+			np.arange(self.top, self.bottom + 1, dtype=np.int32),
+		)
+		zs = np.full(xs.size, self.zoom, dtype=np.int32)
+		return np.stack([zs, xs.ravel(), ys.ravel()], axis=1)
+
+	def pixel_offsets(self):
+		# Returns an (N, 2) array of the [x, y] pixel offset of every tile in
+		# the output mosaic, in the same order as tiles_array
+		indices = np.arange(self.count(), dtype=np.int32)
+		return np.stack([indices % self.width, indices // self.width], axis=1) * 256
+
+	def final_resolution(self):
+		return (self.width * 256, self.height * 256)
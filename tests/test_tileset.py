@@ -0,0 +1,83 @@
+import numpy as np
+
+from mapzendl.tileset import EARTH_CIRCUMFERENCE, TileSet
+
+
+def world_pixel_to_epsg_3857(pixel_x, pixel_y, zoom):
+	# Returns the EPSG:3857 coordinate of the centre of the given whole-world
+	# pixel (256 per tile), so the expected tiles and pixels are unambiguous
+	metres_per_pixel = 2 * EARTH_CIRCUMFERENCE / (256 << zoom)
+	x = -EARTH_CIRCUMFERENCE + (pixel_x + 0.5) * metres_per_pixel
+	y = EARTH_CIRCUMFERENCE - (pixel_y + 0.5) * metres_per_pixel
+	return x, y
+
+
+def bounding_box(zoom, left, top, right, bottom):
+	# Builds a [left, bottom, right, top] bounding box from whole-world pixels
+	left_x, bottom_y = world_pixel_to_epsg_3857(left, bottom, zoom)
+	right_x, top_y = world_pixel_to_epsg_3857(right, top, zoom)
+	return [left_x, bottom_y, right_x, top_y]
+
+
+def test_tileset_bounds_and_crop_pixels():
+	box = bounding_box(
+		10,
+		left=500 * 256 + 10,
+		top=300 * 256 + 40,
+		right=502 * 256 + 200,
+		bottom=301 * 256 + 250,
+	)
+	ts = TileSet(box, 10)
+
+	assert (ts.left, ts.right, ts.top, ts.bottom) == (500, 502, 300, 301)
+	assert (ts.width, ts.height) == (3, 2)
+	assert ts.count() == 6
+	assert ts.final_resolution() == (768, 512)
+
+	# Crop indices into the (height, width) mosaic
+	assert ts.left_pixel == 10
+	assert ts.right_pixel == 2 * 256 + 200
+	assert ts.top_pixel == 40
+	assert ts.bottom_pixel == 256 + 250
+
+
+def test_single_tile_tileset():
+	box = bounding_box(
+		8,
+		left=100 * 256 + 5,
+		top=200 * 256 + 3,
+		right=100 * 256 + 250,
+		bottom=200 * 256 + 100,
+	)
+	ts = TileSet(box, 8)
+
+	assert (ts.left, ts.right, ts.top, ts.bottom) == (100, 100, 200, 200)
+	assert (ts.width, ts.height) == (1, 1)
+	assert (ts.left_pixel, ts.right_pixel) == (5, 250)
+	assert (ts.top_pixel, ts.bottom_pixel) == (3, 100)
+	assert ts.tiles_array().tolist() == [[8, 100, 200]]
+	assert ts.pixel_offsets().tolist() == [[0, 0]]
+
+
+def test_tiles_and_pixel_offsets_share_order():
+	box = bounding_box(
+		10,
+		left=500 * 256 + 10,
+		top=300 * 256 + 40,
+		right=502 * 256 + 200,
+		bottom=301 * 256 + 250,
+	)
+	ts = TileSet(box, 10)
+	tiles = ts.tiles_array()
+	offsets = ts.pixel_offsets()
+
+	assert tiles.shape == (6, 3)
+	assert offsets.shape == (6, 2)
+	assert np.all(tiles[:, 0] == 10)
+	# Row by row from the top left
+	assert tiles[:, 1:].tolist() == [
+		[500, 300], [501, 300], [502, 300],
+		[500, 301], [501, 301], [502, 301],
+	]
+	np.testing.assert_array_equal(offsets[:, 0], (tiles[:, 1] - ts.left) * 256)
+	np.testing.assert_array_equal(offsets[:, 1], (tiles[:, 2] - ts.top) * 256)